@@ -1,14 +1,162 @@
 # This is one of the variations of the three design patterns in airport routing program
 from __future__ import annotations
 from abc import ABC, ABCMeta, abstractmethod
-from typing import Dict, List
-from random import randint, seed
+from typing import Dict, List, NamedTuple
+from types import MappingProxyType
+from threading import Lock
+import os
+from heapq import heappush, heappop, heapreplace, nsmallest, nlargest
+from bisect import bisect_left, insort
+from math import hypot, inf, sqrt
+from array import array
+from itertools import cycle
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from random import Random
+from typing import Iterator
+from time import monotonic, perf_counter, perf_counter_ns
+from functools import wraps
+from datetime import datetime
+import asyncio
+import json
+import mmap
+import struct
+import sys
+
+# Instrumentation
+class LatencyHistogram():
+    """
+    Гистограмма задержек с интервалами по степеням двойки наносекунд
+    """
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0
+
+    def add(self, nanoseconds: int):
+        self.buckets[min(nanoseconds.bit_length(), 63)] += 1
+        self.count += 1
+        self.total += nanoseconds
+
+    def percentile(self, q: float) -> int:
+        """
+        Верхняя граница интервала, в который попадает перцентиль q, в наносекундах
+        """
+        rank = max(1, -(-self.count * q // 100))
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return 1 << bucket
+        return 0
+
+class Metrics():
+    """
+    Счетчики вызовов и гистограммы задержек стратегий и декораторов цены
+    Выключены по умолчанию: пока замеры выключены, в классах стоят исходные методы без оберток,
+    включение (enable или enabled = True) подменяет отмеченные traced методы обертками
+    hooks - функции (имя, наносекунды), вызываемые после каждого замера, например для трассировки
+    Замеры могут приходить из разных потоков (evaluate), поэтому гистограммы меняются под блокировкой
+    """
+    def __init__(self):
+        self._enabled = False
+        self._methods = []
+        self.histograms = {}
+        self.hooks = []
+        self._lock = Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value: bool):
+        self.enable() if value else self.disable()
+
+    def register(self, owner: type, name: str, func, label=None):
+        self._methods.append((owner, name, func, label))
+        if self._enabled:
+            setattr(owner, name, self._wrap(func, label))
+
+    def enable(self):
+        for owner, name, func, label in self._methods:
+            setattr(owner, name, self._wrap(func, label))
+        self._enabled = True
+
+    def disable(self):
+        for owner, name, func, _ in self._methods:
+            setattr(owner, name, func)
+        self._enabled = False
+
+    def _wrap(self, func, label):
+        @wraps(func)
+        def wrapper(obj, *args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(obj, *args, **kwargs)
+            finally:
+                name = label(obj, *args, **kwargs) if label else f'{type(obj).__name__}.{func.__name__}'
+                self.record(name, perf_counter_ns() - start)
+        return wrapper
+
+    def record(self, name: str, nanoseconds: int):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = LatencyHistogram()
+            histogram.add(nanoseconds)
+        for hook in self.hooks:
+            hook(name, nanoseconds)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {name: {'count': h.count, 'mean_us': h.total / h.count / 1000,
+                           'p50_us': h.percentile(50) / 1000, 'p90_us': h.percentile(90) / 1000,
+                           'p99_us': h.percentile(99) / 1000}
+                    for name, h in sorted(self.histograms.items())}
+
+    def text(self) -> str:
+        return ''.join(f'{name} count={item["count"]} mean={item["mean_us"]:.2f}us '
+                       f'p50<={item["p50_us"]:g}us p90<={item["p90_us"]:g}us p99<={item["p99_us"]:g}us\n'
+                       for name, item in self.snapshot().items())
+
+metrics = Metrics()
+
+class _TracedMethod():
+    """
+    Отметка метода для metrics: при создании класса на место отметки ставится сам метод
+    """
+    def __init__(self, func, label):
+        self.func = func
+        self.label = label
+
+    def __set_name__(self, owner, name):
+        setattr(owner, name, self.func)
+        metrics.register(owner, name, self.func, self.label)
+
+def traced(label=None):
+    """
+    Замер метода в metrics, label(self, *args) задает имя, по умолчанию имя класса и метода
+    """
+    def decorator(func):
+        return _TracedMethod(func, label)
+    return decorator
 
 # Strategy implementation
 class RouteContext(): 
     """
     Контекст, определяющий интерфейс
     """
+    ranges = {'Bicycle': (60, 120), 'Car': (10, 40), 'Taxi': (20, 60), 'Bus': (60, 180)}
+    """
+    Диапазоны времени пути в минутах для тестовых данных
+    """
+    _ranking: RouteRanking = None
+
     def __init__(self, strategy: RouteStrategy):
         """
         Принятие стратегии действий через конструктор
@@ -33,36 +181,506 @@ class RouteContext():
         """
         Установка исходных данных, длина пути в минутах
         """
-        seed(1)  # Если требуется изменить тестовые данные, можно изменить сид
-        data = {'Bicycle': randint(60, 120),'Car': randint(10, 40),'Taxi': randint(20, 60),'Bus': randint(60, 180)}
+        rng = Random(1)  # Если требуется изменить тестовые данные, можно изменить сид
+        data = {key: rng.randint(low, high) for key, (low, high) in self.ranges.items()}
+        self.data = data
+        self._ranking = None
+        return data
+
+    def set_schedule(self, table: TravelTimeTable, departure: datetime):
+        """
+        Установка данных по расписанию: время пути каждого вида транспорта на момент отправления
+        """
+        data = table.at(departure)
         self.data = data
+        self._ranking = None
+        return data
+
+    def set_matrix(self, matrix: RouteMatrix, origin, destination):
+        """
+        Установка данных из матрицы корреспонденций на диске без ее загрузки в память
+        """
+        data = matrix.route(origin, destination)
+        self.data = data
+        self._ranking = None
+        return data
+
+    def set_pickup(self, index: StopIndex, x: float, y: float, speed: float = 80.0):
+        """
+        Установка данных по ближайшим к пассажиру остановкам каждого вида транспорта,
+        speed - скорость пешком в единицах координат за минуту
+        """
+        data = index.route(x, y, speed)
+        self.data = data
+        self._ranking = None
+        return data
+
+    def update(self, key: str, minutes):
+        """
+        Изменение времени пути одного вида транспорта без полной пересортировки
+        """
+        if self._ranking is None:
+            self._ranking = RouteRanking(self.data)
+        self.data[key] = minutes
+        self._ranking.update(key, minutes)
+
+    def simulate(self, count: int, workers: int = None, base: int = 1, percentiles=(50, 90, 99)):
+        """
+        Моделирование count сценариев на каждый вид транспорта в пуле процессов
+        У каждого процесса свой генератор, зависящий от base и номера части
+        Результат - перцентили по видам транспорта, например {'Car': {'p50': 25, ...}}
+        """
+        workers = workers or os.cpu_count() or 1
+        shares = [count // workers + (i < count % workers) for i in range(workers)]
+        totals = {key: Counter() for key in self.ranges}
+        with ProcessPoolExecutor(workers) as pool:
+            for part in pool.map(_simulate_part, [self.ranges] * workers, shares,
+                                 [f'{base}:{i}' for i in range(workers)]):
+                for key, counts in part.items():
+                    totals[key].update(counts)
+        data = {key: {f'p{q}': _percentile(counts, count, q) for q in percentiles}
+                for key, counts in totals.items()}
+        self.data = data
+        self._ranking = None
         return data
 
     def out_data(self):
         return self.data
 
+    @traced(lambda self: f'{type(self._strategy).__name__}.analyze')
     def logic(self):
         """
         Контекст делегирует некоторую работу объекту стратегии
+        Если данные обновлялись через update, стратегия может взять готовый порядок
         """
-        result = self._strategy.analyze(self.data)
+        result = None
+        if self._ranking is not None:
+            result = self._strategy.ordered(self._ranking)
+        if result is None:
+            result = self._strategy.analyze(self.data)
         self.result = result
         return result
 
-    def print_result(self):
-        for i in self.result:
+    @traced(lambda self, data, strategy=None: f'{type(strategy or self._strategy).__name__}.evaluate')
+    def evaluate(self, data: Dict, strategy: RouteStrategy = None):
+        """
+        Вариант logic без состояния: данные и стратегия передаются аргументами, результат
+        возвращается и не сохраняется в контексте. Один контекст можно использовать
+        из многих потоков без блокировок
+        """
+        return list((strategy or self._strategy).analyze(data))
+
+    def logic_batch(self, values: array, width: int, top: int = None):
+        """
+        Пакетный вариант logic: values - плоский массив поездок x видов транспорта
+        шириной width, результат - плоский массив индексов видов транспорта по строкам
+        """
+        return self._strategy.analyze_batch(values, width, top)
+
+    def print_result(self, result=None):
+        for i in (self.result if result is None else result):
 	        print(f'{i[0]} on time is around {i[1]} minutes')
 
+class TravelTimeTable():
+    """
+    Время пути в зависимости от времени суток и дня недели
+
+    Для каждого вида транспорта хранится массив значений по интервалам недели (по умолчанию
+    часовым) и заранее посчитанный наклон до следующего интервала, поэтому поиск
+    значения на момент отправления - это одно обращение по индексу и линейная интерполяция
+    """
+    week = 7 * 24 * 3600
+
+    def __init__(self, bucket: int = 3600):
+        if bucket <= 0 or self.week % bucket:
+            raise ValueError(f'bucket must evenly divide a week ({self.week} seconds), got {bucket}')
+        self.bucket = bucket
+        self.size = self.week // bucket
+        self._values = {}
+        self._slopes = {}
+
+    def add_mode(self, key: str, values: List[float]):
+        """
+        values - время пути на начало каждого интервала, начиная с понедельника 00:00
+        """
+        if len(values) != self.size:
+            raise ValueError(f'{key}: expected {self.size} buckets, got {len(values)}')
+        values = array('d', values)
+        self._values[key] = values
+        self._slopes[key] = array('d', (values[(i + 1) % self.size] - values[i] for i in range(self.size)))
+
+    def at(self, departure: datetime) -> Dict:
+        seconds = departure.weekday() * 86400 + departure.hour * 3600 + departure.minute * 60 + departure.second
+        index, offset = divmod(seconds, self.bucket)
+        fraction = offset / self.bucket
+        return {key: values[index] + self._slopes[key][index] * fraction
+                for key, values in self._values.items()}
+
+class RouteMatrix():
+    """
+    Матрица времени пути между точками города по видам транспорта в двоичном файле
+
+    Файл открывается через mmap, значения читаются прямо из отображенной памяти, поэтому
+    открытие не зависит от размера матрицы, а несколько процессов делят одну физическую копию
+    Формат: заголовок '<4sI' (метка и длина описания), описание в JSON, выравнивание до 8 байт
+    и значения float64 в порядке [вид транспорта][откуда][куда]
+    """
+    magic = b'ODM1'
+    header = struct.Struct('<4sI')
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, length = self.header.unpack_from(self._map)
+        if magic != self.magic:
+            self._map.close()
+            raise ValueError(f'{path}: not a route matrix file')
+        meta = json.loads(self._map[self.header.size:self.header.size + length])
+        if meta['byteorder'] != sys.byteorder:
+            self._map.close()
+            raise ValueError(f'{path}: written with {meta["byteorder"]}-endian floats')
+        self.modes = {key: i for i, key in enumerate(meta['modes'])}
+        self.nodes = {self.decode_node(key): i for i, key in enumerate(meta['nodes'])}
+        self.extra = meta.get('extra', {})
+        offset = self._offset(length)
+        self.values = memoryview(self._map)[offset:].cast('d')
+
+    @classmethod
+    def check_node(cls, node) -> None:
+        """
+        В описании файла вершины хранятся в JSON: допустимы строки, числа и кортежи из них
+        """
+        if isinstance(node, tuple):
+            for part in node:
+                cls.check_node(part)
+        elif not isinstance(node, (str, int, float)):
+            raise ValueError(f'node id {node!r} cannot be stored, use str, int, float or tuple')
+
+    @classmethod
+    def decode_node(cls, node):
+        """
+        Кортежи в JSON становятся списками, здесь они превращаются обратно в кортежи
+        """
+        if isinstance(node, list):
+            return tuple(cls.decode_node(part) for part in node)
+        return node
+
+    @classmethod
+    def _offset(cls, length: int) -> int:
+        return -(-(cls.header.size + length) // 8) * 8
+
+    @classmethod
+    def write_header(cls, file, modes: List, nodes: List, extra: Dict = None) -> int:
+        """
+        Запись заголовка и выравнивания, возвращает смещение начала значений
+        """
+        for node in nodes:
+            cls.check_node(node)
+        meta = json.dumps({'modes': list(modes), 'nodes': list(nodes), 'byteorder': sys.byteorder,
+                           'extra': extra or {}}).encode('utf-8')
+        file.write(cls.header.pack(cls.magic, len(meta)) + meta)
+        offset = cls._offset(len(meta))
+        file.write(bytes(offset - cls.header.size - len(meta)))
+        return offset
+
+    @classmethod
+    def write(cls, path: str, modes: List, nodes: List, values: array, extra: Dict = None):
+        """
+        values - плоский массив 'd' длиной len(modes) * len(nodes) ** 2
+        """
+        if len(values) != len(modes) * len(nodes) ** 2:
+            raise ValueError('values do not match modes x nodes x nodes')
+        for node in nodes:
+            cls.check_node(node)
+        with open(path, 'wb') as file:
+            cls.write_header(file, modes, nodes, extra)
+            array('d', values).tofile(file)
+
+    def row(self, mode: str, origin) -> memoryview:
+        """
+        Время пути из origin во все точки одним срезом без копирования
+        Срез ссылается на отображенный файл, его стоит освободить (release) до close()
+        """
+        size = len(self.nodes)
+        start = (self.modes[mode] * size + self.nodes[origin]) * size
+        return self.values[start:start + size]
+
+    def minutes(self, mode: str, origin, destination) -> float:
+        size = len(self.nodes)
+        return self.values[(self.modes[mode] * size + self.nodes[origin]) * size + self.nodes[destination]]
+
+    def route(self, origin, destination) -> Dict:
+        return {mode: self.minutes(mode, origin, destination) for mode in self.modes}
+
+    def close(self):
+        """
+        Закрытие файла. Если еще живы срезы из row(), отображение закроется само,
+        когда их удалит сборщик мусора
+        """
+        self.values.release()
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+        self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class StopIndex():
+    """
+    Пространственный индекс точек посадки (стоянки такси, остановки, велопарковки) на k-d дереве
+
+    Дерево строится один раз: общее и по одному на каждый вид транспорта
+    Поиск ближайших k и точек в радиусе отсекает ветви, которые не могут быть ближе найденного
+    Точка - кортеж (название, вид транспорта, x, y)
+    """
+    def __init__(self, stops: List):
+        kinds = {}
+        for stop in stops:
+            kinds.setdefault(stop[1], []).append(stop)
+        self._trees = {kind: self._build(items, 0) for kind, items in kinds.items()}
+        self._trees[None] = self._build(list(stops), 0)
+
+    @classmethod
+    def _build(cls, stops: List, axis: int):
+        """
+        Узел дерева - (точка, ось, левое поддерево, правое поддерево)
+        """
+        if not stops:
+            return None
+        stops.sort(key=lambda stop: stop[2 + axis])
+        middle = len(stops) // 2
+        return (stops[middle], axis, cls._build(stops[:middle], 1 - axis),
+                cls._build(stops[middle + 1:], 1 - axis))
+
+    def nearest(self, x: float, y: float, k: int = 1, kind: str = None) -> List:
+        """
+        k ближайших точек в виде списка (расстояние, точка) по возрастанию расстояния
+        Для дальней ветви запоминается квадрат расстояния до разделяющей прямой, и она
+        пропускается при извлечении, если к тому времени найдено k более близких точек
+        """
+        if k <= 0:
+            return []
+        found = []
+        stack = [(0, self._trees.get(kind))]
+        while stack:
+            bound, node = stack.pop()
+            if node is None or len(found) >= k and bound >= -found[0][0]:
+                continue
+            stop, axis, left, right = node
+            distance = (stop[2] - x) ** 2 + (stop[3] - y) ** 2
+            if len(found) < k:
+                heappush(found, (-distance, id(stop), stop))
+            elif distance < -found[0][0]:
+                heapreplace(found, (-distance, id(stop), stop))
+            delta = (x, y)[axis] - stop[2 + axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            if len(found) < k or delta * delta < -found[0][0]:
+                stack.append((delta * delta, far))
+            stack.append((0, near))
+        return [(sqrt(-distance), stop) for distance, _, stop in sorted(found, reverse=True)]
+
+    def radius(self, x: float, y: float, r: float, kind: str = None) -> List:
+        """
+        Все точки не дальше r в виде списка (расстояние, точка) по возрастанию расстояния
+        """
+        found = []
+        stack = [self._trees.get(kind)]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            stop, axis, left, right = node
+            distance = hypot(stop[2] - x, stop[3] - y)
+            if distance <= r:
+                found.append((distance, stop))
+            delta = (x, y)[axis] - stop[2 + axis]
+            stack.append(left if delta < 0 else right)
+            if abs(delta) <= r:
+                stack.append(right if delta < 0 else left)
+        return sorted(found, key=lambda item: item[0])
+
+    def route(self, x: float, y: float, speed: float) -> Dict:
+        """
+        Время пешком до ближайшей точки каждого вида транспорта
+        """
+        data = {}
+        for kind in self._trees:
+            if kind is not None:
+                distance, _ = self.nearest(x, y, 1, kind)[0]
+                data[kind] = distance / speed
+        return data
+
+class RouteRanking():
+    """
+    Отсортированный по времени список видов транспорта, который поддерживает контекст
+    Изменение одного значения находит позицию двоичным поиском, без пересортировки
+    """
+    def __init__(self, data: Dict):
+        self._order = {key: i for i, key in enumerate(data)}
+        self._current = dict(data)
+        self._sorted = sorted((value, self._order[key], key) for key, value in data.items())
+
+    def update(self, key: str, value):
+        if key in self._current:
+            old = (self._current[key], self._order[key], key)
+            del self._sorted[bisect_left(self._sorted, old)]
+        else:
+            self._order[key] = len(self._order)
+        self._current[key] = value
+        insort(self._sorted, (value, self._order[key], key))
+
+    def ascending(self):
+        return [(key, value) for value, _, key in self._sorted]
+
+    def descending(self):
+        """
+        По убыванию времени, равные значения - в порядке добавления, как у sorted(reverse=True)
+        """
+        result = []
+        end = len(self._sorted)
+        while end:
+            start = bisect_left(self._sorted, (self._sorted[end - 1][0],), 0, end)
+            result.extend((key, value) for value, _, key in self._sorted[start:end])
+            end = start
+        return result
+
+class ScenarioGenerator():
+    """
+    Генератор тестовых поездок для нагрузочной проверки стратегий и тарифов
+
+    Распределение задается для каждого вида транспорта как имя метода random.Random и его
+    аргументы, например {'Car': ('gauss', 25, 5)}. У каждого потока данных свой генератор,
+    поэтому глобальное состояние random не меняется, а результаты воспроизводимы
+    """
+    def __init__(self, distributions: Dict = None, base: int = 1):
+        if distributions is None:
+            distributions = {key: ('randint', low, high) for key, (low, high) in RouteContext.ranges.items()}
+        self.modes = list(distributions)
+        self.distributions = distributions
+        self.base = base
+
+    def stream(self, worker: int = 0) -> Random:
+        """
+        Независимый генератор для отдельного процесса или потока
+        """
+        return Random(f'{self.base}:{worker}')
+
+    def chunks(self, count: int, size: int = 65536, worker: int = 0) -> Iterator[array]:
+        """
+        count поездок порциями по size, каждая порция - плоский массив поездок x видов
+        транспорта в порядке self.modes, готовый для logic_batch и FarePrice
+        """
+        rng = self.stream(worker)
+        draws = [(getattr(rng, name), args) for name, *args in self.distributions.values()]
+        while count > 0:
+            rows = min(size, count)
+            chunk = array('d', bytes(8 * rows * len(draws)))
+            for column, (draw, args) in enumerate(draws):
+                chunk[column::len(draws)] = array('d', [draw(*args) for _ in range(rows)])
+            count -= rows
+            yield chunk
+
+def stress_evaluate(context: RouteContext, data: Dict, threads: int, calls: int) -> float:
+    """
+    Нагрузочная проверка evaluate: calls вызовов на общем контексте из threads потоков
+    Возвращает число вызовов в секунду
+    """
+    expected = context.evaluate(data)
+    def work(count):
+        for _ in range(count):
+            if context.evaluate(data) != expected:
+                raise RuntimeError('shared context returned a different result')
+    start = perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        for future in [pool.submit(work, calls // threads) for _ in range(threads)]:
+            future.result()
+    return calls // threads * threads / (perf_counter() - start)
+
+def _simulate_part(ranges: Dict, count: int, stream: str) -> Dict:
+    """
+    Часть моделирования для одного процесса, возвращает гистограммы времени пути
+    """
+    rng = Random(stream)
+    return {key: Counter(rng.randint(low, high) for _ in range(count))
+            for key, (low, high) in ranges.items()}
+
+def _percentile(counts: Counter, total: int, q: float):
+    """
+    Перцентиль по гистограмме методом ближайшего ранга
+    """
+    rank = max(1, -(-total * q // 100))
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= rank:
+            return value
+    return None
+
 class RouteStrategy(ABC):
     """
     Интерфейс стратегии, который объявляет операции для всех поддерживаемых версий некоторого алгоритма
 
     Контекст использует такой интерфейс для вызова алгоритма, определенного конкретными стратегиями
     """
+    percentile: str = None
+
+    def __init__(self, percentile: str = None):
+        """
+        percentile выбирает, по какому перцентилю ранжировать результаты simulate
+        """
+        self.percentile = percentile
+
+    def cache_key(self):
+        """
+        Ключ стратегии для QuoteCache, стратегии с собственными параметрами его расширяют
+        """
+        return type(self), self.percentile
+
+    def costs(self, result, price: Dict) -> Dict:
+        """
+        Итоговые цены по результату analyze, только для видов транспорта из этого результата
+        """
+        durations = dict(result)
+        return EndPrice(Component().operator({key: price[key] for key in durations})).operator(durations)
+
+    def items(self, data: Dict):
+        if self.percentile is None:
+            return data.items()
+        return [(key, value[self.percentile]) for key, value in data.items()]
+
     @abstractmethod
     def analyze(self, data: Dict):
         pass
 
+    def ordered(self, ranking: RouteRanking):
+        """
+        Результат по поддерживаемому контекстом порядку, None - если стратегия его не использует
+        """
+        return None
+
+    def analyze_batch(self, values: array, width: int, top: int = None) -> array:
+        """
+        Ранжирование сразу многих поездок без создания словаря и кортежей на каждую
+        При заданном top в каждой строке остаются только первые top видов транспорта
+        """
+        if width < 1:
+            raise ValueError(f'width must be at least 1, got {width}')
+        order = array('H')
+        for start in range(0, len(values), width):
+            order.extend(self.rank(values[start:start + width], top))
+        return order
+
+    def rank(self, row, top: int = None):
+        """
+        Порядок индексов в одной строке, по умолчанию исходный
+        """
+        return range(len(row) if top is None else min(top, len(row)))
+
 """
 Конкретные стратегии реализуют алгоритм, следуя базовому интерфейсу стратегии
 (и этот интерфейс делает стратегии взаимозаменяемыми в контексте)
@@ -70,21 +688,370 @@ class RouteStrategy(ABC):
 
 class Normal(RouteStrategy):
     def analyze(self, data: Dict):
-        return data.items()
+        return self.items(data)
 
 class Fastest(RouteStrategy):
     """
     Поиск быстрого пути
     """
     def analyze(self, data: Dict):
-        return sorted(data.items(), key=lambda x: x[1])
+        return sorted(self.items(data), key=lambda x: x[1])
+
+    def ordered(self, ranking: RouteRanking):
+        return ranking.ascending() if self.percentile is None else None
+
+    def rank(self, row, top: int = None):
+        if top is not None:
+            return nsmallest(top, range(len(row)), key=row.__getitem__)
+        return sorted(range(len(row)), key=row.__getitem__)
 
 class Slowest(RouteStrategy):
     """
     Поиск долгого пути
     """
     def analyze(self, data: Dict):
-        return sorted(data.items(), key=lambda x: x[1], reverse=True)
+        return sorted(self.items(data), key=lambda x: x[1], reverse=True)
+
+    def ordered(self, ranking: RouteRanking):
+        return ranking.descending() if self.percentile is None else None
+
+    def rank(self, row, top: int = None):
+        if top is not None:
+            return nlargest(top, range(len(row)), key=row.__getitem__)
+        return sorted(range(len(row)), key=row.__getitem__, reverse=True)
+
+class RouteGraph():
+    """
+    Взвешенный граф дорожной и транспортной сети аэропорта
+
+    Список смежности строится один раз, после чего по нему выполняются запросы
+    Dijkstra и A* на двоичной куче, каждый за O(E log V)
+    """
+    def __init__(self, speed: float = 1.0):
+        """
+        speed - максимальная скорость в единицах координат за минуту,
+        нужна для допустимой эвристики A*
+        """
+        self._adjacency = {}
+        self._coords = {}
+        self._speed = speed
+
+    def add_node(self, node, x: float = 0.0, y: float = 0.0):
+        self._adjacency.setdefault(node, [])
+        self._coords[node] = (x, y)
+
+    def add_edge(self, source, target, minutes: float, mode: str, both: bool = True):
+        """
+        Добавление участка пути, пройденного одним видом транспорта
+        """
+        self._adjacency.setdefault(source, []).append((target, minutes, mode))
+        self._adjacency.setdefault(target, [])
+        if both:
+            self._adjacency[target].append((source, minutes, mode))
+
+    def _estimate(self, node, target):
+        """
+        Нижняя оценка времени до цели по прямой
+        """
+        if node not in self._coords or target not in self._coords:
+            return 0
+        (x1, y1), (x2, y2) = self._coords[node], self._coords[target]
+        return hypot(x2 - x1, y2 - y1) / self._speed
+
+    def shortest(self, source, target, mode: str = None, astar: bool = False):
+        """
+        Поиск кратчайшего времени пути, mode ограничивает обход одним видом транспорта
+        Если пути нет, возвращается None
+        """
+        estimate = self._estimate if astar else (lambda node, goal: 0)
+        best = {source: 0}
+        heap = [(estimate(source, target), 0, source)]
+        while heap:
+            _, minutes, node = heappop(heap)
+            if node == target:
+                return minutes
+            if minutes > best[node]:
+                continue
+            for neighbour, weight, edge_mode in self._adjacency.get(node, ()):
+                if mode is not None and edge_mode != mode:
+                    continue
+                total = minutes + weight
+                if total < best.get(neighbour, inf):
+                    best[neighbour] = total
+                    heappush(heap, (total + estimate(neighbour, target), total, neighbour))
+        return None
+
+    def distances(self, source, mode: str = None) -> Dict:
+        """
+        Кратчайшее время пути из source во все достижимые вершины
+        """
+        best = {source: 0}
+        heap = [(0, source)]
+        while heap:
+            minutes, node = heappop(heap)
+            if minutes > best[node]:
+                continue
+            for neighbour, weight, edge_mode in self._adjacency.get(node, ()):
+                if mode is not None and edge_mode != mode:
+                    continue
+                total = minutes + weight
+                if total < best.get(neighbour, inf):
+                    best[neighbour] = total
+                    heappush(heap, (total, neighbour))
+        return best
+
+    def nodes(self):
+        return list(self._adjacency)
+
+    def edge_list(self):
+        """
+        Все направленные участки (откуда, куда, минуты, транспорт)
+        """
+        return [(node, *edge) for node, edges in self._adjacency.items() for edge in edges]
+
+    def edges(self, node):
+        return self._adjacency.get(node, ())
+
+    def modes(self):
+        return sorted({edge[2] for edges in self._adjacency.values() for edge in edges})
+
+class GraphRoute(RouteStrategy):
+    """
+    Стратегия, которая берет время пути не из готовых данных, а из графа сети
+    Ключи data задают виды транспорта для сравнения, результат упорядочен как в Fastest
+    """
+    def __init__(self, graph: RouteGraph, source, target, astar: bool = False):
+        self.graph = graph
+        self.source = source
+        self.target = target
+        self.astar = astar
+
+    def cache_key(self):
+        return type(self), self.graph, self.source, self.target, self.astar
+
+    def analyze(self, data: Dict):
+        modes = data.keys() if data else self.graph.modes()
+        result = {}
+        for mode in modes:
+            minutes = self.graph.shortest(self.source, self.target, mode, self.astar)
+            if minutes is not None:
+                result[mode] = minutes
+        return sorted(result.items(), key=lambda x: x[1])
+
+class ItineraryPlanner():
+    """
+    Планировщик поездок из нескольких участков разным транспортом (например Bicycle -> Bus)
+
+    Поиск по меткам (время, цена, число участков) на графе RouteGraph: метка отбрасывается,
+    если в той же вершине с тем же транспортом уже есть метка не хуже по всем трем критериям
+    Пересадка добавляет transfer минут, цена участка считается по тарифам EndPrice
+    """
+    def __init__(self, graph: RouteGraph, price: Dict, transfer: float = 5, legs: int = 3):
+        self.graph = graph
+        self.price = price
+        self.transfer = transfer
+        self.legs = legs
+
+    def plan(self, source, target) -> List:
+        """
+        Парето-оптимальные по времени, цене и числу участков поездки: список
+        (участки, минуты, цена) по возрастанию времени
+        Участок - (транспорт, откуда, куда, минуты)
+        """
+        bags = {}
+        found = []
+        heap = [(0, 0, 0, source, None, None)]
+        counter = 1
+        while heap:
+            minutes, cost, _, node, mode, path = heappop(heap)
+            used = path[1] if path else 0
+            if any(m <= minutes and c <= cost and n <= used for m, c, n, _ in found):
+                continue
+            if node == target and path is not None:
+                found.append((minutes, cost, used, path))
+                continue
+            for neighbour, weight, edge_mode in self.graph.edges(node):
+                if edge_mode not in self.price:
+                    continue
+                change = mode is not None and edge_mode != mode
+                legs = used + (change or mode is None)
+                if legs > self.legs:
+                    continue
+                total = minutes + weight + (self.transfer if change else 0)
+                price = cost + weight * self.price[edge_mode]
+                bag = bags.setdefault((neighbour, edge_mode), [])
+                if any(m <= total and c <= price and n <= legs for m, c, n in bag):
+                    continue
+                bag[:] = [(m, c, n) for m, c, n in bag if not (total <= m and price <= c and legs <= n)]
+                bag.append((total, price, legs))
+                heappush(heap, (total, price, counter, neighbour, edge_mode,
+                                ((edge_mode, node, neighbour, weight), legs, path)))
+                counter += 1
+        return [self._itinerary(minutes, path) for minutes, cost, _, path in found]
+
+    def _itinerary(self, minutes, path):
+        steps = []
+        while path is not None:
+            steps.append(path[0])
+            path = path[2]
+        legs = []
+        for mode, start, end, weight in reversed(steps):
+            if legs and legs[-1][0] == mode:
+                legs[-1] = (mode, legs[-1][1], end, legs[-1][3] + weight)
+            else:
+                legs.append((mode, start, end, weight))
+        durations = dict.fromkeys(self.price, 0)
+        for mode, _, _, weight in legs:
+            durations[mode] += weight
+        cost = sum(EndPrice(self.price).operator(durations).values())
+        return legs, minutes, cost
+
+class ItineraryRoute(RouteStrategy):
+    """
+    Стратегия над планировщиком: поездки упорядочены по времени, как в Fastest
+    """
+    def __init__(self, planner: ItineraryPlanner, source, target):
+        self.planner = planner
+        self.source = source
+        self.target = target
+
+    def cache_key(self):
+        return type(self), self.planner, self.source, self.target
+
+    def costs(self, result, price: Dict) -> Dict:
+        """
+        Цена поездки - сумма цен ее участков по тарифам price
+        Если у нескольких поездок одинаковая цепочка транспорта, берется самая дешевая
+        """
+        costs = {}
+        for legs, _, _ in self.planner.plan(self.source, self.target):
+            durations = {}
+            for mode, _, _, weight in legs:
+                durations[mode] = durations.get(mode, 0) + weight
+            cost = sum(super().costs(durations.items(), price).values())
+            label = ' -> '.join(leg[0] for leg in legs)
+            costs[label] = min(cost, costs.get(label, inf))
+        return costs
+
+    def analyze(self, data: Dict):
+        return [(' -> '.join(leg[0] for leg in legs), minutes)
+                for legs, minutes, _ in self.planner.plan(self.source, self.target)]
+
+_worker_graph: RouteGraph = None
+
+def _init_precompute(graph: RouteGraph):
+    global _worker_graph
+    _worker_graph = graph
+
+def _precompute_origin(origin, modes: List, nodes: List) -> bytes:
+    """
+    Строки таблицы одного отправления по всем видам транспорта, подряд
+    """
+    row = array('d')
+    for mode in modes:
+        best = _worker_graph.distances(origin, mode)
+        row.extend(best.get(node, inf) for node in nodes)
+    return row.tobytes()
+
+class RoutePrecompute():
+    """
+    Предварительный расчет времени пути между всеми парами вершин графа в файл RouteMatrix
+
+    Dijkstra из каждой вершины выполняется в пуле процессов, строки пишутся в файл по мере
+    готовности. Список участков сохраняется рядом в файле path + '.edges', чтобы открытие
+    самой таблицы не разбирало его. В заголовке таблицы и в этом файле записан общий
+    маркер, по которому проверяется, что они от одного запуска. При повторном запуске
+    пересчитываются только отправления, для которых изменившийся участок мог изменить
+    кратчайший путь
+    """
+    def __init__(self, graph: RouteGraph, workers: int = None):
+        self.graph = graph
+        self.workers = workers
+
+    @staticmethod
+    def _weights(edges) -> Dict:
+        weights = {}
+        for source, target, minutes, mode in edges:
+            key = (source, target, mode)
+            weights[key] = min(minutes, weights.get(key, inf))
+        return weights
+
+    @staticmethod
+    def _load_edges(path: str, old: RouteMatrix):
+        """
+        Участки прошлого запуска, None - если файла нет или он не от этой таблицы
+        """
+        try:
+            with open(path + '.edges', encoding='utf-8') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get('token') != old.extra.get('token'):
+            return None
+        return [(RouteMatrix.decode_node(source), RouteMatrix.decode_node(target), minutes, mode)
+                for source, target, minutes, mode in snapshot['edges']]
+
+    def _affected(self, old: RouteMatrix, previous, nodes: List, modes: List, edges) -> List:
+        """
+        Отправления, которые нужно пересчитать по сравнению с прошлой таблицей
+        """
+        if old is None or previous is None or list(old.nodes) != nodes or list(old.modes) != modes:
+            return nodes
+        before, after = self._weights(previous), self._weights(edges)
+        changed = [(key, before.get(key, inf), after.get(key, inf))
+                   for key in before.keys() | after.keys() if before.get(key, inf) != after.get(key, inf)]
+        affected = []
+        for origin in nodes:
+            for (source, target, mode), was, now in changed:
+                to_source = old.minutes(mode, origin, source)
+                if to_source == inf:
+                    continue
+                to_target = old.minutes(mode, origin, target)
+                if now < was and to_source + now < to_target or now > was and to_source + was <= to_target:
+                    affected.append(origin)
+                    break
+        return affected
+
+    def run(self, path: str) -> List:
+        """
+        Обновление файла таблицы, возвращает список пересчитанных отправлений
+        """
+        nodes, modes, edges = self.graph.nodes(), self.graph.modes(), self.graph.edge_list()
+        for node in nodes:
+            RouteMatrix.check_node(node)
+        old = RouteMatrix(path) if os.path.exists(path) else None
+        token = os.urandom(8).hex()
+        try:
+            previous = self._load_edges(path, old) if old is not None else None
+            affected = self._affected(old, previous, nodes, modes, edges)
+            size = len(nodes)
+            index = {node: i for i, node in enumerate(nodes)}
+            temp = path + '.tmp'
+            with open(temp, 'w+b') as file:
+                offset = RouteMatrix.write_header(file, modes, nodes, {'token': token})
+                file.truncate(offset + 8 * len(modes) * size * size)
+                with mmap.mmap(file.fileno(), 0) as target:
+                    values = memoryview(target)[offset:].cast('d')
+                    if old is not None and affected is not nodes:
+                        values[:] = old.values
+                    with ProcessPoolExecutor(self.workers, initializer=_init_precompute,
+                                             initargs=(self.graph,)) as pool:
+                        rows = pool.map(_precompute_origin, affected, [modes] * len(affected),
+                                        [nodes] * len(affected), chunksize=16)
+                        for origin, row in zip(affected, rows):
+                            row = memoryview(row).cast('d')
+                            for k in range(len(modes)):
+                                start = (k * size + index[origin]) * size
+                                values[start:start + size] = row[k * size:(k + 1) * size]
+                    values.release()
+            with open(path + '.edges.tmp', 'w', encoding='utf-8') as file:
+                json.dump({'token': token, 'edges': edges}, file)
+        finally:
+            if old is not None:
+                old.close()
+        os.replace(temp, path)
+        os.replace(path + '.edges.tmp', path + '.edges')
+        return list(affected)
 
 # Decorator implementation
 class Price(object):
@@ -112,10 +1079,65 @@ class EndPrice(Price):
     def __init__(self, obj):
         self.obj = obj
 
+    @traced()
     def operator(self, data: Dict):
         _data = {key: self.obj[key] * data[key] for key in self.obj}
         return _data
 
+class DemandWindow():
+    """
+    Счетчики спроса по видам транспорта в скользящем окне
+
+    Окно разбито на кольцевой буфер интервалов, у каждого вида транспорта хранится сумма
+    по окну. Событие - O(1), устаревшие интервалы обнуляются при сдвиге окна без
+    повторного просмотра истории
+    """
+    def __init__(self, window: float = 300, buckets: int = 30, clock=monotonic):
+        self.width = window / buckets
+        self.buckets = buckets
+        self._clock = clock
+        self._modes = {}
+
+    def _advance(self, key: str, tick: int):
+        state = self._modes.get(key)
+        if state is None:
+            state = self._modes[key] = [[0] * self.buckets, 0, tick]
+        counts, total, last = state
+        for step in range(last + 1, min(tick, last + self.buckets) + 1):
+            total -= counts[step % self.buckets]
+            counts[step % self.buckets] = 0
+        state[1], state[2] = total, max(tick, last)
+        return state
+
+    def record(self, key: str, count: int = 1):
+        tick = int(self._clock() // self.width)
+        state = self._advance(key, tick)
+        state[0][tick % self.buckets] += count
+        state[1] += count
+
+    def total(self, key: str) -> int:
+        return self._advance(key, int(self._clock() // self.width))[1]
+
+class SurgePrice(Price):
+    """
+    Декоратор над EndPrice, повышающий цену при спросе выше обычного
+    Множитель - отношение спроса за окно к обычному baseline, от 1 до cap
+    """
+    def __init__(self, obj: Price, demand: DemandWindow, baseline: Dict, cap: float = 3.0):
+        self.obj = obj
+        self.demand = demand
+        self.baseline = baseline
+        self.cap = cap
+
+    def multiplier(self, key: str) -> float:
+        if not self.baseline.get(key):
+            return 1.0
+        return min(self.cap, max(1.0, self.demand.total(key) / self.baseline[key]))
+
+    @traced()
+    def operator(self, data: Dict):
+        return {key: value * self.multiplier(key) for key, value in self.obj.operator(data).items()}
+
 class OutPrice(Price):
     """
     Дополнение для вывода данных, использует структуру декоратора, но ничего не изменяет
@@ -123,16 +1145,80 @@ class OutPrice(Price):
     def __init__(self, obj):
         self.obj = obj
 
+    @traced()
     def operator(self):
         for i in self.obj.items():
 	        print(f'{i[0]} will cost around {i[1]} rubles')
 
+class FarePrice(Price):
+    """
+    Колоночный вариант EndPrice: тарифы хранятся массивом, выровненным по видам транспорта,
+    а на вход подается плоский массив длительностей поездки x видов транспорта
+    """
+    def __init__(self, obj: Dict):
+        self.modes = list(obj)
+        self.scale = array('d', (obj[key] for key in self.modes))
+        self.shift = array('d', bytes(8 * len(self.modes)))
+
+    @traced()
+    def operator(self, durations: array) -> array:
+        """
+        Вся пачка считается за один проход, надбавки и скидки уже свернуты в scale и shift
+        """
+        return array('d', [minutes * scale + shift for minutes, scale, shift
+                           in zip(durations, cycle(self.scale), cycle(self.shift))])
+
+class FareStage(FarePrice):
+    """
+    Декоратор над тарифом, изменяющий его коэффициенты один раз при создании
+    modes ограничивает действие выбранными видами транспорта
+    """
+    def __init__(self, obj: FarePrice, modes: List = None):
+        self.obj = obj
+        self.modes = obj.modes
+        self.scale = array('d', obj.scale)
+        self.shift = array('d', obj.shift)
+        self.selected = [i for i, key in enumerate(self.modes) if modes is None or key in modes]
+
+class Surcharge(FareStage):
+    """
+    Фиксированная надбавка к цене поездки
+    """
+    def __init__(self, obj: FarePrice, amount: float, modes: List = None):
+        super().__init__(obj, modes)
+        for i in self.selected:
+            self.shift[i] += amount
+
+class Discount(FareStage):
+    """
+    Скидка в долях от итоговой цены
+    """
+    def __init__(self, obj: FarePrice, rate: float, modes: List = None):
+        super().__init__(obj, modes)
+        for i in self.selected:
+            self.scale[i] *= 1 - rate
+            self.shift[i] *= 1 - rate
+
+class FareOut(Price):
+    """
+    Колоночный вариант OutPrice, весь текст выводится одной записью в поток
+    """
+    def __init__(self, obj: FarePrice, costs: array):
+        self.obj = obj
+        self.costs = costs
+
+    def operator(self, stream=None):
+        lines = [f'{key} will cost around {cost:g} rubles\n'
+                 for key, cost in zip(cycle(self.obj.modes), self.costs)]
+        (stream or sys.stdout).write(''.join(lines))
+
             
 
 # Singleton implementation (through metaclasses)
 class DataView(type):
     """
     Реализация одиночки через метакласс
+    Повторный вызов с аргументами передает их в метод reload экземпляра, если он есть
     """
     _instances = {}
 
@@ -140,18 +1226,228 @@ class DataView(type):
         if cls not in cls._instances:
             instance = super().__call__(*args, **kwargs)
             cls._instances[cls] = instance
+        elif (args or kwargs) and hasattr(cls._instances[cls], 'reload'):
+            cls._instances[cls].reload(*args, **kwargs)
         return cls._instances[cls]
 
 
+class PriceSnapshot(NamedTuple):
+    """
+    Неизменяемая версия таблицы тарифов
+    """
+    version: int
+    data: MappingProxyType
+
 class DataSave(metaclass=DataView):
     """
     Логика одиночки - выдача данных 
+
+    Данные хранятся как неизменяемый снимок с номером версии. Читатели получают снимок
+    одним чтением ссылки без блокировок, писатель собирает новую копию и подменяет ссылку
     """
+    _lock: Lock = Lock()
+
     def __init__(self, data: List):
-        self.data = data
+        self._snapshot = PriceSnapshot(1, MappingProxyType(dict(data)))
+
+    @property
+    def data(self):
+        return self._snapshot.data
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def snapshot(self) -> PriceSnapshot:
+        return self._snapshot
 
     def get_data(self):
-        return self.data
+        return self._snapshot.data
+
+    def reload(self, data: Dict) -> PriceSnapshot:
+        """
+        Вызывается при повторном DataSave(data): новые тарифы публикуются, те же - нет
+        """
+        snapshot = self._snapshot
+        if dict(snapshot.data) == dict(data):
+            return snapshot
+        return self.publish(data)
+
+    def publish(self, data: Dict) -> PriceSnapshot:
+        """
+        Горячая замена тарифов. Блокировка нужна только писателям между собой,
+        уже начатые расчеты продолжают работать со своим снимком
+        """
+        with self._lock:
+            snapshot = PriceSnapshot(self._snapshot.version + 1, MappingProxyType(dict(data)))
+            self._snapshot = snapshot
+        return snapshot
+
+# Proxy implementation (caching quotes)
+class QuoteCache():
+    """
+    Заместитель перед стратегией и декораторами цены, запоминающий готовые расчеты
+
+    Ключ - strategy.cache_key() и содержимое данных маршрута и тарифов
+    Старые записи вытесняются по LRU и по времени жизни ttl в секундах
+    При публикации новой версии тарифов в хранилище DataSave кэш очищается целиком
+    """
+    def __init__(self, store: DataSave = None, size: int = 1024, ttl: float = None, clock=monotonic):
+        self._store = store
+        self._size = size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._price_key = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def fingerprint(data: Dict):
+        """
+        Содержимое данных в виде ключа, вложенные словари (перцентили simulate) тоже учитываются
+        """
+        return tuple((key, tuple(sorted(value.items())) if isinstance(value, dict) else value)
+                     for key, value in data.items())
+
+    def quote(self, strategy: RouteStrategy, data: Dict, price: Dict = None):
+        """
+        Возвращает пару из результата стратегии и итоговых цен по видам транспорта
+        """
+        if price is None:
+            snapshot = self._store.snapshot()
+            price, price_key = snapshot.data, snapshot.version
+        else:
+            price_key = self.fingerprint(price)
+        if price_key != self._price_key:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._price_key = price_key
+
+        key = (strategy.cache_key(), self.fingerprint(data))
+        now = self._clock()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if self._ttl is None or now - entry[0] < self._ttl:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            del self._entries[key]
+            self.evictions += 1
+
+        self.misses += 1
+        result = list(strategy.analyze(data))
+        costs = strategy.costs(result, price)
+        self._entries[key] = (now, (result, costs))
+        if len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return result, costs
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations, 'size': len(self._entries)}
+
+# Asyncio quote service
+class QuoteServer():
+    """
+    TCP сервис расчета поездок, одна строка JSON на запрос и одна на ответ
+    Запрос: {"strategy": "Fastest", "route": {"Car": 20, ...}}
+
+    Одновременные запросы собираются в пачку в течение window секунд (или до batch штук)
+    и считаются одним пакетным вызовом стратегии и колоночного тарифа
+    """
+    strategies = {'Normal': Normal, 'Fastest': Fastest, 'Slowest': Slowest}
+
+    def __init__(self, store: DataSave, window: float = 0.002, batch: int = 256):
+        self._store = store
+        self._window = window
+        self._batch = batch
+        self._pending = []
+        self._timer = None
+
+    def submit(self, request: Dict) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((request, future))
+        if len(self._pending) >= self._batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self.flush)
+        return future
+
+    def flush(self):
+        """
+        Расчет накопленной пачки: запросы группируются по стратегии и набору видов транспорта
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        price = self._store.get_data()
+        groups = {}
+        for request, future in pending:
+            try:
+                strategy = self.strategies[request.get('strategy', 'Fastest')]
+                route = request['route']
+                if not isinstance(route, dict):
+                    raise TypeError('route must be an object')
+                if not route:
+                    raise ValueError('route must not be empty')
+                if not all(isinstance(value, (int, float)) for value in route.values()):
+                    raise TypeError('route values must be numbers')
+            except Exception as error:
+                self._resolve(future, {'error': f'bad request: {error}'})
+                continue
+            groups.setdefault((strategy, tuple(route)), []).append((request, future))
+
+        for (strategy, modes), items in groups.items():
+            try:
+                width = len(modes)
+                values = array('d', (request['route'][mode] for request, _ in items for mode in modes))
+                order = strategy().analyze_batch(values, width)
+                costs = FarePrice({mode: price[mode] for mode in modes}).operator(values)
+                responses = []
+                for row in range(len(items)):
+                    start = row * width
+                    responses.append({
+                        'result': [[modes[i], values[start + i]] for i in order[start:start + width]],
+                        'cost': {mode: costs[start + i] for i, mode in enumerate(modes)},
+                    })
+            except KeyError as error:
+                responses = [{'error': f'unknown tariff: {error}'}] * len(items)
+            except Exception as error:
+                responses = [{'error': f'internal error: {error}'}] * len(items)
+            for (_, future), response in zip(items, responses):
+                self._resolve(future, response)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, response: Dict):
+        """
+        Ответ на запрос, если клиент еще ждет его (соединение могло закрыться)
+        """
+        if not future.done():
+            future.set_result(response)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while line := await reader.readline():
+            try:
+                request = json.loads(line)
+            except ValueError as error:
+                response = {'error': f'bad json: {error}'}
+            else:
+                response = await self.submit(request)
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+            await writer.drain()
+        writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
 
 if __name__ == "__main__":
     context = RouteContext(Fastest())
@@ -1,12 +1,19 @@
 # This is one of the variations of the three design patterns in document processing
 from __future__ import annotations
-from collections.abc import Iterable, Iterator
+from collections.abc import Iterable, Iterator, Sequence
 from abc import ABC, abstractmethod
 from random import randrange, sample
-from typing import Any, List
+from typing import Any, Dict, List
 from datetime import datetime
+from time import monotonic
 from string import ascii_letters, digits
+from collections import OrderedDict
+from threading import Condition, Lock, RLock, Thread
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+import asyncio
 import hashlib
+import weakref
 
 class Message:
     """
@@ -50,9 +57,10 @@ class TextCryptor(Iterator):
     """
     _position: int = None
 
-    def __init__(self, collection: Words) -> None:
+    def __init__(self, collection: Words, cache: DigestCache = None) -> None:
         self._collection = collection
         self._position = 0
+        self._cache = cache
 
     def __str__(self):
         return list(self.value)
@@ -66,30 +74,259 @@ class TextCryptor(Iterator):
         """
         try:
             value = self._collection[self._position]
-            value = hashlib.sha1(value.encode('utf-8')).hexdigest()
+            if self._cache is None:
+                value = hashlib.sha1(value.encode('utf-8')).hexdigest()
+            else:
+                value = self._cache.sha1(value)
             self._position += 1
         except IndexError:
             raise StopIteration()
 
         return value
 
+class DigestCache:
+    """
+    Общий кэш хэшей для повторяющихся слов, имен и получателей
+    Ограничен числом записей и/или объемом (длина слова плюс 40 символов хэша),
+    вытесняет давно не использованные записи
+    Один кэш можно передать многим итераторам, в том числе из разных потоков
+    """
+    digest_size = 40
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def sha1(self, value: str) -> str:
+        with self._lock:
+            digest = self._entries.get(value)
+            if digest is not None:
+                self._entries.move_to_end(value)
+                self.hits += 1
+                return digest
+            self.misses += 1
+        digest = hashlib.sha1(value.encode('utf-8')).hexdigest()
+        with self._lock:
+            if value not in self._entries:
+                self._entries[value] = digest
+                self.bytes += len(value) + self.digest_size
+                self._evict()
+        return digest
+
+    def _evict(self):
+        while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                                 or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            value, _ = self._entries.popitem(last=False)
+            self.bytes -= len(value) + self.digest_size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.bytes,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+def _chunks(source, size: int):
+    """
+    Чтение источника порциями байт: файл (текстовый или двоичный) или итератор строк
+    """
+    if hasattr(source, 'read'):
+        while chunk := source.read(size):
+            yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+    else:
+        for chunk in source:
+            yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+class StreamCryptor(Iterator):
+    """
+    Потоковый вариант TextCryptor для текстов, которые не помещаются в память
+    Текст читается порциями по chunk байт и делится по пробелам как Message.text_list,
+    хэш слова накапливается через update, поэтому даже длинное слово не хранится целиком
+    """
+    def __init__(self, source, chunk: int = 1 << 16) -> None:
+        self._words = self._hash_words(_chunks(source, chunk))
+
+    @staticmethod
+    def _hash_words(chunks):
+        current = hashlib.sha1()
+        for chunk in chunks:
+            start = 0
+            while (end := chunk.find(b' ', start)) != -1:
+                current.update(chunk[start:end])
+                yield current.hexdigest()
+                current = hashlib.sha1()
+                start = end + 1
+            current.update(chunk[start:])
+        yield current.hexdigest()
+
+    def __next__(self):
+        return next(self._words)
+
+def sha1_stream(source, chunk: int = 1 << 16) -> str:
+    """
+    Хэш всего текста целиком при чтении порциями
+    """
+    digest = hashlib.sha1()
+    for part in _chunks(source, chunk):
+        digest.update(part)
+    return digest.hexdigest()
+
 class Words(Iterable):
     """
     Конкретные Коллекции предоставляют один или несколько методов для получения
     новых экземпляров итератора, совместимых с классом коллекции
     """
-    def __init__(self, collection: List[Any] = []) -> None:
+    def __init__(self, collection: List[Any] = [], cache: DigestCache = None) -> None:
         self._collection = collection
+        self._hashed = None
+        self._cache = cache
 
     def __iter__(self) -> TextCryptor:
         """
         Метод __iter__() возвращает объект итератора
         """
-        return TextCryptor(self._collection)
+        return TextCryptor(self._collection, self._cache)
 
     def add_item(self, item: Any):
         self._collection.append(item)
 
+    def hashed(self) -> HashedView:
+        """
+        Общее для коллекции представление с доступом к хэшу по индексу
+        """
+        if self._hashed is None:
+            self._hashed = HashedView(self._collection)
+        return self._hashed
+
+    def hash_all(self, workers: int = None, processes: bool = False, chunk: int = 4096,
+                 threshold: int = 10000, compact: bool = False):
+        """
+        Пакетное шифрование всей коллекции с сохранением порядка
+        Потоки подходят для длинных строк (hashlib отпускает GIL на больших данных),
+        процессы - для множества коротких. Коллекции меньше threshold шифруются обычным итератором
+        При compact=True результат - DigestStore с двоичными хэшами вместо списка строк
+        """
+        if len(self._collection) < threshold:
+            if compact:
+                return DigestStore(_sha1_chunk(self._collection, True))
+            return list(self)
+        chunks = [self._collection[i:i + chunk] for i in range(0, len(self._collection), chunk)]
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        with executor(workers) as pool:
+            parts = pool.map(partial(_sha1_chunk, compact=compact), chunks)
+            if compact:
+                store = DigestStore()
+                for part in parts:
+                    store.extend(part)
+                return store
+            return [value for part in parts for value in part]
+
+def _sha1_chunk(items: List[str], compact: bool = False):
+    """
+    Шифрование части коллекции: список строк или, при compact, склеенные двоичные хэши
+    """
+    if compact:
+        return b''.join(hashlib.sha1(item.encode('utf-8')).digest() for item in items)
+    return [hashlib.sha1(item.encode('utf-8')).hexdigest() for item in items]
+
+class HashedView(Sequence):
+    """
+    Ленивое представление коллекции в виде хэшей с доступом по индексу и срезам
+    Хэш считается только для запрошенного элемента и запоминается
+    Коллекция может расти через add_item, уже посчитанные хэши остаются верными
+    """
+    def __init__(self, collection: List[Any]) -> None:
+        self._collection = collection
+        self._cache = {}
+
+    def __len__(self):
+        return len(self._collection)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('hashed view index out of range')
+        value = self._cache.get(index)
+        if value is None:
+            value = hashlib.sha1(self._collection[index].encode('utf-8')).hexdigest()
+            self._cache[index] = value
+        return value
+
+class DigestStore:
+    """
+    Компактное хранение хэшей sha1: двоичные 20 байт подряд в одном bytearray
+    Строка из 40 шестнадцатеричных символов собирается только по запросу (hex, hexdigests)
+
+    Индекс, срез и обход возвращают memoryview без копирования. Пока такие срезы
+    не освобождены (release или удаление), append и extend вызывают BufferError
+    """
+    size = 20
+
+    def __init__(self, data: bytes = b''):
+        if len(data) % self.size:
+            raise ValueError(f'digest data length must be a multiple of {self.size}')
+        self._data = bytearray(data)
+
+    def __len__(self):
+        return len(self._data) // self.size
+
+    def __getitem__(self, index) -> memoryview:
+        """
+        Двоичный хэш элемента или подряд идущих элементов среза без копирования
+        Срезы с шагом не поддерживаются, так как не дают непрерывного буфера
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('digest slices must have step 1')
+            return memoryview(self._data)[start * self.size:max(start, stop) * self.size]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('digest index out of range')
+        return memoryview(self._data)[index * self.size:(index + 1) * self.size]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def hexdigests(self):
+        """
+        Обход хэшей в виде строк
+        """
+        for index in range(len(self)):
+            yield self.hex(index)
+
+    def append(self, digest: bytes):
+        if len(digest) != self.size:
+            raise ValueError(f'digest must be {self.size} bytes')
+        self._data += digest
+
+    def extend(self, data: bytes):
+        if len(data) % self.size:
+            raise ValueError(f'digest data length must be a multiple of {self.size}')
+        self._data += data
+
+    def hex(self, index: int) -> str:
+        return self[index].hex()
+
+    def view(self) -> memoryview:
+        """
+        Все хэши одним буфером для передачи на запись без копирования
+        Пока полученные срезы не освобождены, добавлять хэши в хранилище нельзя
+        """
+        return memoryview(self._data)
+
 # Observer implementation
 class MessageObserver:
     """
@@ -100,42 +337,302 @@ class MessageObserver:
     """
     Для удобства в этой переменной хранится состояние
     """
-    _observers = []
-    """
-    Список наблюдателей
-    """
 
-    def attach(self, observer) -> None:
+    def __init__(self) -> None:
+        # Наблюдатели по темам (например, получателю), тема None - подписка на все оповещения
+        # Слабые ссылки не удерживают удаленные сообщения в памяти, опустевшая тема удаляется
+        self._observers = {}
+
+    def attach(self, observer, topic: Any = None) -> None:
         print("Subject: Attached an observer.")
-        self._observers.append(observer)
+        subject, key = weakref.ref(self), id(observer)
+
+        def prune(ref):
+            owner = subject()
+            if owner is not None:
+                owner._discard(topic, key, ref)
 
-    def detach(self, observer) -> None:
-        self._observers.remove(observer)
+        self._observers.setdefault(topic, {})[key] = weakref.ref(observer, prune)
+
+    def detach(self, observer, topic: Any = None) -> None:
+        ref = self._observers.get(topic, {}).get(id(observer))
+        if ref is None or ref() is not observer:
+            raise ValueError("observer is not attached")
+        self._discard(topic, id(observer), ref)
+
+    def _discard(self, topic: Any, key: int, ref) -> None:
+        group = self._observers.get(topic)
+        if group is None or group.get(key) is not ref:
+            return
+        del group[key]
+        if not group:
+            del self._observers[topic]
 
     """
     Методы управления подпиской
     """
-    def notify(self) -> None:
+    def subscribers(self, topic: Any = None) -> List:
+        """
+        Наблюдатели темы вместе с подписанными на все, без темы - все наблюдатели
+        """
+        if topic is None:
+            groups = list(self._observers.values())
+        else:
+            groups = [self._observers.get(None, {}), self._observers.get(topic, {})]
+        # Наблюдатель, подписанный на несколько тем, получает оповещение один раз
+        unique = {}
+        for group in groups:
+            for key, ref in list(group.items()):
+                observer = ref()
+                if observer is not None:
+                    unique[key] = observer
+        return list(unique.values())
+
+    def notify(self, topic: Any = None) -> None:
         """
         Запуск обновления в каждом наблюдателе
         """
         print("Subject: Notifying observers...")
-        for observer in self._observers:
+        for observer in self.subscribers(topic):
             print("Message sent")
             observer.update(self)
 
-    def send(self, message_state: bool) -> None:
+    def send(self, message_state: bool, topic: Any = None) -> None:
         """
         Отслеживание отправки сообщения
         """
-        self._state = message_state
+        self.set_state(message_state)
 
         print("Message on the way") if message_state else print("WTF, error")
-        self.notify()
+        self.notify(topic)
+
+    def get_state(self):
+        return self._state
+
+    def set_state(self, message_state: bool) -> None:
+        """
+        Изменение состояния без оповещения, для внешних механизмов доставки
+        """
+        self._state = message_state
+
+class CoalescingSender:
+    """
+    Объединение частых вызовов send в пачки
+
+    Изменения состояния копятся, пока не наберется batch вызовов или не пройдет window секунд
+    с первого из них, после чего каждый затронутый наблюдатель получает одно обновление
+    с последним состоянием. Если первое изменение пачки не отправлено сразу, заводится таймер
+    на window секунд: call_later внутри цикла asyncio, иначе срок передается одному фоновому
+    потоку отправителя, который ждет его на Condition и завершается после idle секунд простоя.
+    Поэтому конец пачки доставляется и без следующего send. flush() доставляет изменения сразу
+    """
+    idle = 1.0
+    def __init__(self, subject: MessageObserver, window: float = 0.001, batch: int = 100,
+                 clock=monotonic) -> None:
+        self.subject = subject
+        self.window = window
+        self.batch = batch
+        self._clock = clock
+        self._topics = set()
+        self._pending = 0
+        self._started = None
+        self._timer = None
+        self._deadline = None
+        self._flusher = None
+        self._lock = RLock()
+        self._wakeup = Condition(self._lock)
+        self.sends = 0
+        self.batches = 0
+        self.updates = 0
+
+    def send(self, message_state: bool, topic: Any = None) -> None:
+        with self._lock:
+            self.subject.set_state(message_state)
+            self._topics.add(topic)
+            self._pending += 1
+            self.sends += 1
+            now = self._clock()
+            first = self._started is None
+            if first:
+                self._started = now
+            if self._pending >= self.batch or now - self._started >= self.window:
+                self.flush()
+            elif first:
+                self._arm()
+
+    def _arm(self) -> None:
+        try:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        except RuntimeError:
+            self._deadline = monotonic() + self.window
+            if self._flusher is None:
+                self._flusher = Thread(target=CoalescingSender._run, args=(weakref.ref(self),),
+                                       daemon=True)
+                self._flusher.start()
+            self._wakeup.notify()
+
+    @staticmethod
+    def _run(ref) -> None:
+        # Поток держит отправителя только слабой ссылкой, чтобы не мешать его удалению
+        while True:
+            sender = ref()
+            if sender is None:
+                return
+            with sender._wakeup:
+                if sender._deadline is None:
+                    sender._wakeup.wait(sender.idle)
+                    if sender._deadline is None:
+                        sender._flusher = None
+                        return
+                delay = sender._deadline - monotonic()
+                if delay > 0:
+                    sender._wakeup.wait(delay)
+                else:
+                    sender.flush()
+
+    def flush(self) -> None:
+        """
+        Доставка накопленных изменений, каждому наблюдателю не больше одного обновления
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._deadline = None
+            if not self._pending:
+                return
+            topics, self._topics = self._topics, set()
+            self._pending = 0
+            self._started = None
+            self.batches += 1
+            if None in topics:
+                topics = {None}
+            observers = {id(observer): observer for topic in topics
+                         for observer in self.subject.subscribers(topic)}
+            for observer in observers.values():
+                observer.update(self.subject)
+                self.updates += 1
+
+class StateEvent:
+    """
+    Снимок состояния на момент отправки, передается наблюдателю вместо самого субъекта
+    """
+    def __init__(self, state: bool) -> None:
+        self._state = state
 
     def get_state(self):
         return self._state
 
+class AsyncDelivery:
+    """
+    Асинхронная доставка оповещений MessageObserver
+
+    У каждого наблюдателя своя очередь asyncio.Queue размером maxsize и своя задача доставки,
+    поэтому медленный наблюдатель не задерживает остальных, а send() только ставит события в очереди
+    При переполнении overflow выбирает поведение: 'drop_oldest', 'drop_newest' или 'error'
+    update наблюдателя может быть обычной функцией или корутиной
+    С политикой 'error' событие не ставится ни в одну очередь, если хотя бы одна заполнена
+    """
+    policies = ('drop_oldest', 'drop_newest', 'error')
+
+    def __init__(self, subject: MessageObserver, maxsize: int = 100, overflow: str = 'drop_oldest') -> None:
+        if overflow not in self.policies:
+            raise ValueError(f"overflow must be one of {self.policies}")
+        self.subject = subject
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._channels = weakref.WeakKeyDictionary()
+        # Задачи доставки хранятся отдельно: запись наблюдателя исчезает вместе с ним,
+        # а задачу все равно нужно остановить
+        self._tasks = set()
+
+    def _channel(self, observer) -> Dict:
+        channel = self._channels.get(observer)
+        if channel is None:
+            loop = asyncio.get_running_loop()
+            queue = asyncio.Queue(self.maxsize)
+            channel = {'queue': queue, 'delivered': 0, 'dropped': 0, 'failed': 0}
+            task = loop.create_task(self._deliver(weakref.ref(observer), queue, channel))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            channel['finalizer'] = weakref.finalize(observer, self._cancel, loop, task)
+            channel['task'] = task
+            self._channels[observer] = channel
+        return channel
+
+    @staticmethod
+    def _cancel(loop: asyncio.AbstractEventLoop, task: asyncio.Task) -> None:
+        """
+        Остановка задачи удаленного наблюдателя, сборщик мусора может вызвать это из любого потока
+        """
+        if not task.done() and not loop.is_closed():
+            loop.call_soon_threadsafe(task.cancel)
+
+    @staticmethod
+    async def _deliver(ref, queue: asyncio.Queue, channel: Dict) -> None:
+        while True:
+            event = await queue.get()
+            try:
+                observer = ref()
+                if observer is None:
+                    return
+                try:
+                    result = observer.update(event)
+                    if asyncio.iscoroutine(result):
+                        await result
+                    channel['delivered'] += 1
+                except Exception:
+                    channel['failed'] += 1
+                del observer
+            finally:
+                queue.task_done()
+
+    def send(self, message_state: bool, topic: Any = None) -> None:
+        """
+        Изменение состояния и постановка события в очереди наблюдателей без ожидания доставки
+        Должен вызываться внутри работающего цикла событий
+        """
+        observers = self.subject.subscribers(topic)
+        channels = [self._channel(observer) for observer in observers]
+        if self.overflow == 'error':
+            for observer, channel in zip(observers, channels):
+                if channel['queue'].full():
+                    raise asyncio.QueueFull(f"queue for {observer!r} is full")
+        self.subject.set_state(message_state)
+        event = StateEvent(message_state)
+        for channel in channels:
+            queue = channel['queue']
+            if queue.full():
+                channel['dropped'] += 1
+                if self.overflow == 'drop_newest':
+                    continue
+                queue.get_nowait()
+                queue.task_done()
+            queue.put_nowait(event)
+
+    def backpressure(self) -> Dict:
+        """
+        Состояние очередей: ожидающие, доставленные, отброшенные и ошибочные события
+        """
+        return {observer: {'queued': channel['queue'].qsize(), 'delivered': channel['delivered'],
+                           'dropped': channel['dropped'], 'failed': channel['failed']}
+                for observer, channel in list(self._channels.items())}
+
+    async def drain(self) -> None:
+        """
+        Ожидание доставки всех поставленных в очереди событий
+        """
+        await asyncio.gather(*(channel['queue'].join() for channel in list(self._channels.values())))
+
+    async def close(self) -> None:
+        for channel in list(self._channels.values()):
+            channel['finalizer'].detach()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._channels = weakref.WeakKeyDictionary()
+
 # Memento implementation
 class Memento:
     """
@@ -190,9 +687,10 @@ if __name__ == "__main__":
     collection.add_item(letter.text)   
     collection.add_item(letter.recipient) 
 
-    name = "\n".join(collection)[0:40]
-    text = "\n".join(collection)[41:81]
-    recipient = "\n".join(collection)[82:122]
+    hashed = collection.hashed()
+    name = hashed[0]
+    text = hashed[1]
+    recipient = hashed[2]
 
     letter.name = name
     letter.text = text